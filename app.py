@@ -1,130 +1,217 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import streamlit as st
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 import zipfile
 from io import BytesIO
 import numpy as np
 
+try:
+    import numba
+except ImportError:
+    # The app still works without the accelerator; the pipeline falls back to
+    # the pandas groupby path
+    numba = None
+
 def generate_master_timeline():
-    start = datetime(2025, 1, 1, 0, 0)
-    end = datetime(2025, 8, 31, 23, 45)
-    timestamps = []
-    current = start
-    while current <= end:
-        timestamps.append(current)
-        current += timedelta(minutes=15)
-    return timestamps
-
-def detect_and_correct_abnormal_readings(meter_data):
+    """Build the 15-minute master timeline as a DatetimeIndex (constructed in C)."""
+    return pd.date_range(datetime(2025, 1, 1, 0, 0), datetime(2025, 8, 31, 23, 45), freq='15min')
+
+# Built once at import so every Streamlit rerun reuses the same index.
+MASTER_TIMESTAMPS = generate_master_timeline()
+# Output format of the timeline, formatted once instead of once per meter
+MASTER_TS_STR = MASTER_TIMESTAMPS.strftime('%d/%m/%Y %H:%M').to_numpy()
+
+def _correct_multiples(r, tol=0.01):
     """
     Detect and correct abnormal readings where readings are multiples of normal pattern.
     Example: 143204.01, 286408.02 (2x), 143204.01
+
+    Operates on a plain float array of one meter's readings in timestamp order,
+    so callers can apply it without copying whole DataFrames per group.
+    `tol` is the relative tolerance for the multiple match (0.01 = 1%).
+    Returns the corrected array and the number of corrected readings.
     """
-    if len(meter_data) < 3:
-        return meter_data
-    
-    # Sort by timestamp
-    meter_data = meter_data.sort_values('Timestamp').reset_index(drop=True)
-    
-    # Calculate differences between consecutive readings
-    meter_data['Reading_Diff'] = meter_data['Energy Reading'].diff()
-    meter_data['Next_Reading_Diff'] = meter_data['Energy Reading'].diff(-1).abs()
-    
-    # Look for patterns where a reading is approximately multiple of adjacent readings
-    for i in range(1, len(meter_data)-1):
-        current_reading = meter_data.loc[i, 'Energy Reading']
-        prev_reading = meter_data.loc[i-1, 'Energy Reading']
-        next_reading = meter_data.loc[i+1, 'Energy Reading']
-        
-        # Check if current reading is approximately 2x of both neighbors
-        if (abs(current_reading - 2 * prev_reading) / prev_reading < 0.01 and 
-            abs(current_reading - 2 * next_reading) / next_reading < 0.01):
-            # Replace with average of neighbors (more robust than simple division)
-            corrected_reading = (prev_reading + next_reading) / 2
-            meter_data.loc[i, 'Energy Reading'] = corrected_reading
-            st.info(f"✅ Corrected abnormal reading at {meter_data.loc[i, 'Timestamp']}: {current_reading} → {corrected_reading}")
-        
-        # Check for 3x patterns
-        elif (abs(current_reading - 3 * prev_reading) / prev_reading < 0.01 and 
-              abs(current_reading - 3 * next_reading) / next_reading < 0.01):
-            corrected_reading = (prev_reading + next_reading) / 2
-            meter_data.loc[i, 'Energy Reading'] = corrected_reading
-            st.info(f"✅ Corrected abnormal reading at {meter_data.loc[i, 'Timestamp']}: {current_reading} → {corrected_reading}")
-    
-    return meter_data
-
-def calculate_meter_consumption(meter_data, master_timestamps):
-    """Calculate consumption for a single meter with proper edge case handling"""
-    if meter_data.empty:
-        return pd.DataFrame({
-            'Timestamp': master_timestamps,
-            'Meter': meter_data.name if hasattr(meter_data, 'name') else 'Unknown',
-            'Volume Consumption': 0.0
-        })
-    
-    # Convert to numeric and clean
-    meter_data = meter_data.copy()
-    meter_data['Energy Reading'] = pd.to_numeric(meter_data['Energy Reading'], errors='coerce')
-    
-    # Remove rows where timestamp conversion failed
-    meter_data = meter_data.dropna(subset=['Timestamp'])
-    
-    # Sort by timestamp
-    meter_data = meter_data.sort_values('Timestamp')
-    
-    # Remove duplicates (keep first occurrence)
-    meter_data = meter_data.drop_duplicates(subset=['Timestamp'], keep='first')
-    
-    # Detect and correct abnormal readings (multiples pattern)
-    original_count = len(meter_data)
-    meter_data = detect_and_correct_abnormal_readings(meter_data)
-    corrected_count = len(meter_data)
-    
-    if original_count != corrected_count:
-        st.warning(f"Applied corrections for abnormal readings in meter {meter_data['Meter'].iloc[0]}")
-    
-    # Get valid readings (non-null, non-negative counter values)
-    valid_mask = meter_data['Energy Reading'].notna()
-    
-    # Special handling: if first valid reading is 0, it's acceptable
-    if valid_mask.any():
-        first_valid_idx = valid_mask.idxmax()
-        valid_readings = meter_data[valid_mask].copy()
-        
-        # Calculate consumption
-        valid_readings['Volume Consumption'] = valid_readings['Energy Reading'].diff()
-        
-        # First valid reading gets consumption = 0
-        if not valid_readings.empty:
-            valid_readings.iloc[0, valid_readings.columns.get_loc('Volume Consumption')] = 0
-        
-        # Replace negative consumption with 0
-        valid_readings.loc[valid_readings['Volume Consumption'] < 0, 'Volume Consumption'] = 0
-        
-        # Merge with master timeline
-        master_df = pd.DataFrame({'Timestamp': master_timestamps})
-        result_df = master_df.merge(
-            valid_readings[['Timestamp', 'Volume Consumption']], 
-            on='Timestamp', 
-            how='left'
-        )
-        result_df['Volume Consumption'] = result_df['Volume Consumption'].fillna(0.0)
-        result_df['Meter'] = meter_data['Meter'].iloc[0] if not meter_data.empty else 'Unknown'
-        
-        # Convert timestamp back to original format
-        result_df['Timestamp'] = result_df['Timestamp'].dt.strftime('%d/%m/%Y %H:%M')
-        
-        return result_df[['Timestamp', 'Meter', 'Volume Consumption']]
+    if r.size < 3:
+        return r, 0
+
+    # The jitted core avoids even the mask allocations of the numpy path
+    if numba is not None:
+        out = r.copy()
+        fixed = _correct_multiples_core(r, out, tol)
+        return out, fixed
+
+    # Compare every interior reading against its neighbors via shifted slices;
+    # unlike np.roll this allocates no wrapped copies and needs no edge fixup
+    prev, curr, nxt = r[:-2], r[1:-1], r[2:]
+
+    # Check if a reading is approximately 2x or 3x of both neighbors; the
+    # multiplied form avoids dividing by zero/NaN neighbors
+    mask2 = (np.abs(curr - 2 * prev) < tol * np.abs(prev)) & (np.abs(curr - 2 * nxt) < tol * np.abs(nxt))
+    mask3 = (np.abs(curr - 3 * prev) < tol * np.abs(prev)) & (np.abs(curr - 3 * nxt) < tol * np.abs(nxt))
+
+    # Replace with average of neighbors (more robust than simple division)
+    mask = mask2 | mask3
+    out = r.copy()
+    out[1:-1] = np.where(mask, (prev + nxt) / 2, curr)
+    return out, int(np.count_nonzero(mask))
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _correct_multiples_core(src, out, tol):
+        """Scalar counterpart of the numpy masks in _correct_multiples.
+
+        Reads the original readings from src and writes corrections into out
+        (a copy of src), so detection always compares uncorrected neighbors.
+        Returns the number of corrected readings.
+        """
+        fixed = 0
+        for i in range(1, src.shape[0] - 1):
+            p = src[i - 1]
+            c = src[i]
+            n = src[i + 1]
+            if ((abs(c - 2 * p) < tol * abs(p) and abs(c - 2 * n) < tol * abs(n)) or
+                    (abs(c - 3 * p) < tol * abs(p) and abs(c - 3 * n) < tol * abs(n))):
+                out[i] = (p + n) / 2
+                fixed += 1
+        return fixed
+
+    @numba.njit(cache=True)
+    def _consumption_kernel(energy, meter_codes, out):
+        """Single-pass per-meter diff with first-reading and negative clamping.
+
+        Expects rows sorted by (meter, timestamp); matches
+        groupby().diff().clip(lower=0).fillna(0) without the three
+        intermediate allocations.
+        """
+        prev = 0.0
+        last_code = -1
+        for i in range(energy.shape[0]):
+            code = meter_codes[i]
+            if code != last_code:
+                out[i] = 0.0
+                last_code = code
+            else:
+                d = energy[i] - prev
+                out[i] = d if d > 0.0 else 0.0
+            prev = energy[i]
+
+def compute_all_consumption(combined_data, enable_correction=True, tolerance=0.01):
+    """Compute 15-minute volume consumption for every meter in one vectorized pass.
+
+    Returns a DataFrame with one row per (meter, master timestamp), zero-filled
+    where a meter has no valid reading. The per-meter diff runs once in C over
+    the whole sorted array instead of once per meter in Python.
+    `enable_correction` gates the multiples correction and `tolerance` is its
+    relative match threshold.
+    """
+    # Remove rows where timestamp conversion failed (dropna already returns a
+    # fresh frame, so no extra copy is needed before mutating)
+    combined_data = combined_data.dropna(subset=['Timestamp'])
+    combined_data['Energy Reading'] = pd.to_numeric(combined_data['Energy Reading'], errors='coerce')
+
+    # One global sort/dedup instead of a sort per meter. Everything below -
+    # the multiples correction, the consumption kernel, and the grid scatter -
+    # relies on this (Meter, Timestamp) order and must not re-sort
+    combined_data = (combined_data
+                     .sort_values(['Meter', 'Timestamp'])
+                     .drop_duplicates(subset=['Meter', 'Timestamp'], keep='first'))
+
+    # Keep every meter in the output, even those without valid readings; the
+    # category codes below index into this same list
+    unique_meters = combined_data['Meter'].cat.categories
+
+    # Detect and correct abnormal readings (multiples pattern) per meter,
+    # working on each group's numpy values rather than frame copies
+    readings = combined_data.dropna(subset=['Energy Reading'])
+    if enable_correction:
+        corrected_total = 0
+
+        def _apply(s):
+            nonlocal corrected_total
+            corrected, n_fixed = _correct_multiples(s.to_numpy(dtype=np.float64), tolerance)
+            corrected_total += n_fixed
+            return corrected
+
+        readings['Energy Reading'] = (readings
+                                      .groupby('Meter', sort=False, observed=True)['Energy Reading']
+                                      .transform(_apply))
+        # One summary message instead of a websocket round-trip per correction
+        if corrected_total:
+            st.info(f"✅ Corrected {corrected_total} abnormal readings across all meters")
+
+    # Single diff over the whole array; first reading per meter becomes 0,
+    # negative consumption (counter resets) is clipped to 0
+    if numba is not None:
+        vol = np.empty(len(readings), dtype=np.float64)
+        _consumption_kernel(readings['Energy Reading'].to_numpy(dtype=np.float64),
+                            readings['Meter'].cat.codes.to_numpy(dtype=np.int64),
+                            vol)
+        readings['Volume Consumption'] = vol
     else:
-        # No valid readings for this meter
-        result_df = pd.DataFrame({
-            'Timestamp': master_timestamps,
-            'Meter': meter_data['Meter'].iloc[0] if not meter_data.empty else 'Unknown',
-            'Volume Consumption': 0.0
-        })
-        # Convert timestamp back to original format
-        result_df['Timestamp'] = result_df['Timestamp'].dt.strftime('%d/%m/%Y %H:%M')
-        return result_df
+        readings['Volume Consumption'] = (readings
+                                          .groupby('Meter', sort=False, observed=True)['Energy Reading']
+                                          .diff().clip(lower=0).fillna(0))
+
+    # Align every meter to the master timeline by scattering the consumption
+    # values into a flat (meter x slot) grid addressed with int64 epoch
+    # searchsorted lookups - contiguous numpy ops, no MultiIndex hash join
+    n_slots = len(MASTER_TIMESTAMPS)
+    # Pin the grid to ns epochs: pandas 3.x builds date_range at µs
+    # resolution, and the readings side is normalized to ns below
+    master_i8 = MASTER_TIMESTAMPS.as_unit('ns').asi8
+
+    # Widen the category codes to int64: pandas hands back its smallest code
+    # dtype (int8 for <128 meters), which overflows in the flat-index math
+    codes = readings['Meter'].cat.codes.to_numpy(np.int64)
+    ts_i8 = readings['Timestamp'].to_numpy('datetime64[ns]').view(np.int64)
+    slot = np.searchsorted(master_i8, ts_i8)
+    slot = np.minimum(slot, n_slots - 1)
+    # Readings outside the master grid (off-interval or out of range) are
+    # dropped, just as the old reindex left them unmatched; so is a NaN Meter,
+    # whose code of -1 would otherwise wrap into the last meter's block
+    on_grid = (master_i8[slot] == ts_i8) & (codes >= 0)
+
+    # 15-minute deltas need ~6 significant digits at most, so float32 halves
+    # the bytes moved through the CSV encode and DEFLATE stages; the diff
+    # itself stays in float64 to subtract the large counter values cleanly
+    cons = np.zeros(len(unique_meters) * n_slots, dtype=np.float32)
+    cons[codes[on_grid] * n_slots + slot[on_grid]] = readings['Volume Consumption'].to_numpy()[on_grid]
+
+    # Every meter block follows the master timeline order, so the formatted
+    # strings can be tiled instead of re-running strftime per row. copy=False
+    # adopts the three freshly built arrays as the frame's blocks outright
+    return pd.DataFrame({
+        'Timestamp': np.tile(MASTER_TS_STR, len(unique_meters)),
+        'Meter': np.repeat(np.asarray(unique_meters), n_slots),
+        'Volume Consumption': cons,
+    }, copy=False)
+
+def _encode_meter_csv(item):
+    """Worker: render one meter's result slice to CSV bytes for the ZIP.
+
+    Runs in a ProcessPoolExecutor, so it must stay a picklable top-level
+    function and must not touch Streamlit.
+    """
+    meter, result_df = item
+    buf = BytesIO()
+    result_df.to_csv(buf, index=False)
+    return f"{meter}.csv", buf.getvalue()
+
+@st.cache_data(show_spinner=False)
+def _read_one_excel(file_bytes, name):
+    """Parse one uploaded workbook, cached on its content so Streamlit reruns
+    (expander toggles, download clicks) skip the Excel parse entirely."""
+    # Energy Reading is deliberately not pinned: a single non-numeric cell
+    # would fail the whole read, whereas the pipeline's to_numeric(coerce)
+    # turns bad cells into NaN and keeps the rest of the file. No usecols
+    # either - a missing column must reach the caller's validation branch
+    # rather than raise in here; the caller trims to the required columns
+    return pd.read_excel(BytesIO(file_bytes), engine='calamine',
+                         dtype={'Meter': 'string'})
 
 def read_excel_files(uploaded_files):
     """Read all uploaded Excel files and combine data"""
@@ -139,16 +226,17 @@ def read_excel_files(uploaded_files):
     
     for i, file in enumerate(uploaded_files):
         try:
-            # Read Excel file
-            df = pd.read_excel(file)
-            
+            # Read Excel file (content-hashed cache; see _read_one_excel)
+            df = _read_one_excel(file.getvalue(), file.name)
+
             # Validate required columns
             missing_columns = [col for col in required_columns if col not in df.columns]
             if missing_columns:
                 st.warning(f"File {file.name} missing columns: {missing_columns}. Skipping.")
                 continue
-                
-            all_data.append(df)
+
+            # Keep only the columns the pipeline uses
+            all_data.append(df[required_columns])
             st.success(f"✅ Successfully read {file.name}")
             
         except Exception as e:
@@ -160,14 +248,14 @@ def read_excel_files(uploaded_files):
     
     # Combine all data
     combined_data = pd.concat(all_data, ignore_index=True)
+    # Categorical meter IDs make every downstream groupby/equality an integer
+    # code comparison instead of Python string hashing
+    combined_data['Meter'] = combined_data['Meter'].astype('category')
     return combined_data
 
 def main():
     st.title("Meter Data Processing App")
-    
-    # Generate master timeline
-    master_timestamps = generate_master_timeline()
-    
+
     # File uploader for multiple Excel files
     uploaded_files = st.file_uploader(
         "Upload Excel files", 
@@ -213,69 +301,95 @@ def main():
                 if combined_data is None:
                     return
                 
-                # Store original timestamp format for output
-                original_timestamps = combined_data['Timestamp'].copy()
-                
-                # Convert timestamp with error handling
-                combined_data['Timestamp'] = pd.to_datetime(
-                    combined_data['Timestamp'], 
-                    format='%d/%m/%Y %H:%M', 
-                    errors='coerce'
-                )
+                # Convert timestamp with error handling; skip parsing entirely
+                # when Excel already delivered datetime cells, and let cache=True
+                # deduplicate repeated strings (meters share the 15-min grid)
+                ts = combined_data['Timestamp']
+                if not pd.api.types.is_datetime64_any_dtype(ts):
+                    ts = pd.to_datetime(
+                        ts,
+                        format='%d/%m/%Y %H:%M',
+                        errors='coerce',
+                        cache=True
+                    )
+                combined_data['Timestamp'] = ts
                 
                 # Check for timestamp conversion failures
                 failed_conversions = combined_data['Timestamp'].isna().sum()
                 if failed_conversions > 0:
                     st.warning(f"Failed to convert {failed_conversions} timestamps. These rows will be ignored.")
                 
-                # Get unique meters
-                unique_meters = combined_data['Meter'].unique()
+                # Get unique meters (an O(1) attribute read on the categorical)
+                unique_meters = combined_data['Meter'].cat.categories
                 st.write(f"Found {len(unique_meters)} unique meters")
                 
-                # Process each meter
-                zip_buffer = BytesIO()
+                # Compute consumption for all meters in one vectorized pass
+                result = compute_all_consumption(
+                    combined_data,
+                    enable_correction=enable_correction,
+                    tolerance=tolerance_percentage / 100
+                )
+
+                # Pre-split once so each worker receives only its meter's slice;
+                # the sample sections below reuse this dict instead of rescanning
+                groups = dict(tuple(result.groupby('Meter', sort=False, observed=True)))
+
+                # Encode meters in parallel; the ZIP itself is written serially
+                # in the main process since ZipFile is not safe to share.
+                # Spooling to a temp file keeps only one meter's payload in RAM
+                # instead of retaining the whole archive in a BytesIO
+                zip_tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
+                zip_tmp.close()
                 processed_meters = 0
-                
-                with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-                    for meter in unique_meters:
-                        meter_data = combined_data[combined_data['Meter'] == meter].copy()
-                        
-                        result_df = calculate_meter_consumption(meter_data, master_timestamps)
-                        
-                        # Save to CSV in memory
-                        csv_buffer = BytesIO()
-                        # Convert to CSV string
-                        csv_data = result_df.to_csv(index=False)
-                        # Write CSV data to buffer
-                        csv_buffer.write(csv_data.encode('utf-8'))
-                        csv_buffer.seek(0)
-                        
-                        # Add CSV to ZIP
-                        zip_file.writestr(f"{meter}.csv", csv_buffer.getvalue())
-                        processed_meters += 1
-                        progress_bar.progress(processed_meters / len(unique_meters))
-                
-                zip_buffer.seek(0)
-                
-                st.success(f"✅ Processing complete! Processed {processed_meters} meters.")
-                
-                # Download button
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.download_button(
-                        label="📥 Download ZIP File with CSV Output",
-                        data=zip_buffer,
-                        file_name="meter_consumption_data.zip",
-                        mime="application/zip",
-                        use_container_width=True
-                    )
+
+                # Each progress call is a websocket round-trip, so update at
+                # most ~100 times rather than once per meter
+                progress_step = max(1, len(unique_meters) // 100)
+
+                # Hand workers batches of meters so IPC overhead amortizes over
+                # several tasks while still keeping all cores busy
+                cpu_count = os.cpu_count() or 1
+                map_chunksize = max(1, len(groups) // (4 * cpu_count))
+
+                # The spool file must not outlive this block, even when the
+                # write or the download handoff fails
+                try:
+                    # Level 1 DEFLATE is ~3-5x faster than the default level 6
+                    # for these numeric CSVs at a ~10% size cost
+                    with zipfile.ZipFile(zip_tmp.name, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zip_file:
+                        with ProcessPoolExecutor(max_workers=cpu_count) as executor:
+                            for name, payload in executor.map(_encode_meter_csv, groups.items(),
+                                                              chunksize=map_chunksize):
+                                zip_file.writestr(name, payload)
+                                processed_meters += 1
+                                if processed_meters % progress_step == 0 or processed_meters == len(unique_meters):
+                                    progress_bar.progress(processed_meters / len(unique_meters))
+
+                    st.success(f"✅ Processing complete! Processed {processed_meters} meters.")
+
+                    # First meter's slice, shared by the sample download and the
+                    # preview expander below
+                    sample_meter = unique_meters[0] if processed_meters > 0 else None
+                    sample_result = groups.get(sample_meter) if sample_meter is not None else None
+
+                    # Download button
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        with open(zip_tmp.name, 'rb') as zip_handle:
+                            st.download_button(
+                                label="📥 Download ZIP File with CSV Output",
+                                data=zip_handle,
+                                file_name="meter_consumption_data.zip",
+                                mime="application/zip",
+                                use_container_width=True
+                            )
+                finally:
+                    if os.path.exists(zip_tmp.name):
+                        os.unlink(zip_tmp.name)
                 
                 with col2:
                     # Also provide option to download a sample CSV
-                    if processed_meters > 0:
-                        sample_meter = unique_meters[0]
-                        sample_data = combined_data[combined_data['Meter'] == sample_meter].copy()
-                        sample_result = calculate_meter_consumption(sample_data, master_timestamps)
+                    if sample_result is not None:
                         sample_csv = sample_result.to_csv(index=False)
                         
                         st.download_button(
@@ -288,11 +402,7 @@ def main():
                 
                 # Show sample of processed data
                 with st.expander("👀 Preview Processed Data Format"):
-                    if processed_meters > 0:
-                        sample_meter = unique_meters[0]
-                        sample_data = combined_data[combined_data['Meter'] == sample_meter].copy()
-                        sample_result = calculate_meter_consumption(sample_data, master_timestamps)
-                        
+                    if sample_result is not None:
                         st.write(f"Sample data for meter: {sample_meter}")
                         st.write("Timestamp format in output:", sample_result['Timestamp'].iloc[0] if not sample_result.empty else "No data")
                         st.dataframe(sample_result.head(10) if not sample_result.empty else "No data available")
@@ -301,8 +411,8 @@ def main():
                 with st.expander("📊 Processing Statistics"):
                     st.write(f"Total Excel files processed: {len(uploaded_files)}")
                     st.write(f"Total meters processed: {processed_meters}")
-                    st.write(f"Total timestamps in master timeline: {len(master_timestamps)}")
-                    st.write(f"Date range: {master_timestamps[0].strftime('%d/%m/%Y')} to {master_timestamps[-1].strftime('%d/%m/%Y')}")
+                    st.write(f"Total timestamps in master timeline: {len(MASTER_TIMESTAMPS)}")
+                    st.write(f"Date range: {MASTER_TIMESTAMPS[0].strftime('%d/%m/%Y')} to {MASTER_TIMESTAMPS[-1].strftime('%d/%m/%Y')}")
                     
                     # File size info
                     total_size = sum(file.size for file in uploaded_files)